@@ -1,6 +1,114 @@
-from typing import List, Tuple
+from functools import lru_cache
+from typing import Callable, Iterable, List, Optional, Tuple
 from gmpy2 import xmpz
+import atexit
 import multiprocessing as mp
+import multiprocessing.pool
+import os
+import threading
+
+# bits per dimension from which the O(log bits) shift/mask cascade outruns the O(bits) xmpz slice assignment;
+# the break-even point grows with dims, from about 300 bits for 2D to about 350 bits for 4D to 6D
+_CASCADE_MIN_BITS = 352
+
+# the same for the shift/mask cascade against the xmpz slice reads when decoding
+_DECODE_CASCADE_MIN_BITS = 384
+
+# bits per dimension up to which batches are interlaced by a generated kernel of unrolled spread table lookups
+_KERNEL_MAX_BITS = 64
+
+# batch size below which par_interlace and par_deinterlace do not bother the worker pool
+_PAR_MIN_BATCH = 10000
+
+# worker pool shared by all par_interlace and par_deinterlace calls; started on first use by the process _POOL_PID
+_POOL: Optional[mp.pool.Pool] = None
+_POOL_PID: Optional[int] = None
+_POOL_LOCK = threading.Lock()
+
+# actions of the LITMAX and BIGMIN decision tables, indexed by (CODE_BIT << 2) | (MIN_BIT << 1) | MAX_BIT;
+# _SKIP is the only falsy action and the remaining ones are ordered by how often the bitscans hit them
+_SKIP, _LOAD_MIN, _LOAD_MAX, _SPLIT, _RETURN_MIN, _RETURN_MAX, _RETURN_RESULT, _INVALID = range(0, 8)
+_LITMAX_ACTIONS = (_SKIP, _LOAD_MAX, _INVALID, _RETURN_RESULT, _RETURN_MAX, _SPLIT, _INVALID, _SKIP)
+_BIGMIN_ACTIONS = (_SKIP, _SPLIT, _INVALID, _RETURN_MIN, _RETURN_RESULT, _LOAD_MIN, _INVALID, _SKIP)
+
+
+def _max_bit_length(values: Iterable[int]) -> int:
+    """
+    Return the bit length of the largest of the given values, but at least 1.
+    """
+    # a plain scan is cheaper than max(1, *values), which unpacks values into a fresh argument tuple
+    largest = 1
+    for v in values:
+        if v > largest:
+            largest = v
+
+    return largest.bit_length()
+
+
+@lru_cache(maxsize=None)
+def _spread_steps(dims: int, bits: int) -> Tuple[Tuple[int, ...], Tuple[int, ...]]:
+    """
+    Return the shift/mask cascade that spreads the lowest bits of an integer dims positions apart.
+
+    :param dims: int
+        The dimensionality of the underlying data space.
+    :param bits: int
+        The number of encoding bits per dimension.
+    :return: Tuple[Tuple[int, ...], Tuple[int, ...]]
+        The shifts and the masks of the cascade, masks[0] being the plain bits_per_dim mask.
+    """
+    span = 1
+    while span < bits:
+        span <<= 1
+
+    shifts, masks = [], [(1 << bits) - 1]
+    while span > 1:
+        span >>= 1
+        shifts.append(span * (dims - 1))
+        masks.append(sum(1 << ((k // span) * span * dims + k % span) for k in range(bits)))
+
+    return tuple(shifts), tuple(masks)
+
+
+def _spread(v: int, dims: int, bits: int) -> int:
+    """
+    Deposit the lowest bits of v on every dims-th bit position (i.e. a software PDEP).
+    """
+    shifts, masks = _spread_steps(dims, bits)
+    v &= masks[0]
+    for shift, mask in zip(shifts, masks[1:]):
+        v = (v | (v << shift)) & mask
+
+    return v
+
+
+def _compact(v: int, dims: int, bits: int) -> int:
+    """
+    Gather every dims-th bit of v into the lowest bits (i.e. a software PEXT); the inverse of _spread.
+    """
+    shifts, masks = _spread_steps(dims, bits)
+    v &= masks[-1]
+    for shift, mask in zip(reversed(shifts), reversed(masks[:-1])):
+        v = (v | (v >> shift)) & mask
+
+    return v
+
+
+@lru_cache(maxsize=64)
+def _axis_masks(dims: int, total_bits: int) -> Tuple[int, ...]:
+    """
+    Return the masks selecting the bits of every dimension within a Morton code of total_bits bits.
+    """
+    stripe = ((1 << (dims * -(-total_bits // dims))) - 1) // ((1 << dims) - 1)
+    return tuple((stripe << a) & ((1 << total_bits) - 1) for a in range(0, dims))
+
+
+@lru_cache(maxsize=None)
+def _spread_table(dims: int) -> Tuple[int, ...]:
+    """
+    Return the 256-entry lookup table holding every byte value spread dims positions apart.
+    """
+    return tuple(_spread(b, dims, 8) for b in range(256))
 
 
 def interlace(*data_point: int, dims: int = None, bits_per_dim: int = None) -> int:
@@ -17,7 +125,21 @@ def interlace(*data_point: int, dims: int = None, bits_per_dim: int = None) -> i
         A 1D Morton code point
     """
     dims = len(data_point) if dims is None else dims
-    bits_per_dim = max(1, *data_point).bit_length() if bits_per_dim is None else bits_per_dim
+    bits_per_dim = _max_bit_length(data_point) if bits_per_dim is None else bits_per_dim
+
+    if bits_per_dim <= 8:
+        spread_table, mask = _spread_table(dims), (1 << bits_per_dim) - 1
+        c = 0
+        for i, v in enumerate(data_point):
+            c |= spread_table[v & mask] << i
+        return c
+
+    if bits_per_dim >= _CASCADE_MIN_BITS:
+        c = 0
+        for i, v in enumerate(data_point):
+            c |= _spread(v, dims, bits_per_dim) << i
+        return c
+
     total_bits = dims * bits_per_dim
     c = xmpz()
 
@@ -27,22 +149,117 @@ def interlace(*data_point: int, dims: int = None, bits_per_dim: int = None) -> i
     return int(c)
 
 
+def _get_pool() -> mp.pool.Pool:
+    """
+    Return the shared worker pool, starting it on first use.
+    """
+    global _POOL, _POOL_PID
+
+    with _POOL_LOCK:
+        # a forked child inherits the pool object, but neither its workers nor its handler threads
+        if _POOL is None or _POOL_PID != os.getpid():
+            _POOL, _POOL_PID = mp.Pool(mp.cpu_count()), os.getpid()
+
+        return _POOL
+
+
+def _close_pool() -> None:
+    """
+    Shut down the shared worker pool, if started by this process.
+    """
+    global _POOL, _POOL_PID
+
+    with _POOL_LOCK:
+        if _POOL is not None and _POOL_PID == os.getpid():
+            _POOL.close()
+            _POOL.join()
+        _POOL, _POOL_PID = None, None
+
+
+def _reset_pool_lock() -> None:
+    """
+    Replace the pool lock in a forked child, where it may have been inherited in a locked state.
+    """
+    global _POOL_LOCK
+
+    _POOL_LOCK = threading.Lock()
+
+
+atexit.register(_close_pool)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_pool_lock)
+
+
+def _chunks(items: List, n_chunks: int) -> List[List]:
+    """
+    Split items into at most n_chunks contiguous chunks of (almost) equal size.
+    """
+    size = max(1, -(-len(items) // n_chunks))
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+@lru_cache(maxsize=64)
+def _interlace_kernel(dims: int, bits_per_dim: int) -> Callable[[List[List[int]]], List[int]]:
+    """
+    Generate a batch interlacing function specialized for the given dims and bits_per_dim.
+
+    The generated function encodes each data point by a single expression of spread table lookups, one for every
+    byte of every coordinate, with all shifts and masks baked in as literals.
+    """
+    lookups = []
+    for i in range(0, dims):
+        for k in range(0, bits_per_dim, 8):
+            byte = "x%d" % i if k == 0 else "x%d >> %d" % (i, k)
+            lookups.append("spread_table[%s & %d] << %d" % (byte, (1 << min(8, bits_per_dim - k)) - 1, dims * k + i))
+
+    source = "def kernel(data_points):\n    return [%s for %s, in data_points]\n" % (
+        " | ".join(lookups), ", ".join("x%d" % i for i in range(0, dims)))
+
+    namespace = {"spread_table": _spread_table(dims)}
+    exec(source, namespace)
+
+    return namespace["kernel"]
+
+
+def _interlace_batch(data_points: List[List[int]], dims: int = None, bits_per_dim: int = None) -> List[int]:
+    """
+    Interlace a batch of multi-dimensional data points within a single worker task.
+    """
+    if dims is not None and bits_per_dim is not None and 0 < bits_per_dim <= _KERNEL_MAX_BITS:
+        try:
+            return _interlace_kernel(dims, bits_per_dim)(data_points)
+        except ValueError:
+            # some data point does not have exactly dims coordinates
+            pass
+
+    return [interlace(*data_point, dims=dims, bits_per_dim=bits_per_dim) for data_point in data_points]
+
+
 def par_interlace(data_points: List[List[int]], dims: int = None, bits_per_dim: int = None) -> List[int]:
     """
+    Interlace a batch of multi-dimensional data points into their 1D Morton code points in parallel.
 
-    :param data_points:
-    :param dims:
-    :param bits_per_dim:
-    :return:
+    :param data_points: List[List[int]]
+        The multi-dimensional data points to encode.
+    :param dims: int, optional
+        The dimensionality of the underlying data space.; will speed things up if given.
+    :param bits_per_dim: int, optional
+        The number of encoding bits per dimension; will speed things up if given.
+    :return: List[int]
+        The 1D Morton code points in the order of data_points.
     """
-    from functools import partial
+    if bits_per_dim is None:
+        # the encoding does not depend on the exact width, hence a single width for the whole batch will do
+        bits_per_dim = _max_bit_length(v for data_point in data_points for v in data_point)
 
-    _interlace = partial(interlace, dims=dims, bits_per_dim=bits_per_dim)
+    if len(data_points) < _PAR_MIN_BATCH:
+        return _interlace_batch(data_points, dims, bits_per_dim)
 
-    with mp.Pool(mp.cpu_count()) as pool:
-        code_points = pool.starmap(_interlace, data_points, chunksize=None)
+    # ship whole chunks to the workers to avoid pickling and dispatching every single data point
+    chunks = _chunks(data_points, 4 * mp.cpu_count())
+    code_points = _get_pool().starmap(_interlace_batch, [(chunk, dims, bits_per_dim) for chunk in chunks])
 
-    return code_points
+    return [code_point for chunk in code_points for code_point in chunk]
 
 
 def deinterlace(code_point: int, dims: int = 3, total_bits: int = None) -> List[int]:
@@ -57,7 +274,78 @@ def deinterlace(code_point: int, dims: int = 3, total_bits: int = None) -> List[
         A multi-dimensional data point.
     """
     total_bits = code_point.bit_length() + (dims - code_point.bit_length() % dims) if total_bits is None else total_bits
-    return [int(xmpz(code_point)[i:total_bits:dims]) for i in range(0, dims)]
+    bits_per_dim = -(-total_bits // dims)
+
+    if bits_per_dim >= _DECODE_CASCADE_MIN_BITS:
+        code_point &= (1 << total_bits) - 1
+        return [_compact(code_point >> i, dims, bits_per_dim) for i in range(0, dims)]
+
+    c = xmpz(code_point)
+    return [int(c[i:total_bits:dims]) for i in range(0, dims)]
+
+
+def _deinterlace_batch(code_points: List[int], dims: int = 3, total_bits: int = None) -> List[List[int]]:
+    """
+    Deinterlace a batch of 1D Morton code points in a single pass.
+
+    All code points are packed into the byte-aligned blocks of one integer, so that every step of the
+    _compact cascade decodes the whole batch with a single big-integer operation.
+    """
+    if not code_points:
+        return []
+
+    if total_bits is None:
+        # the decoding does not depend on the exact width, hence a single width for the whole batch will do
+        total_bits = max(code_points).bit_length()
+
+    if -(-total_bits // dims) >= _DECODE_CASCADE_MIN_BITS:
+        # from this width on padding the whole batch costs more than decoding code point by code point
+        return [deinterlace(code_point, dims, total_bits) for code_point in code_points]
+
+    code_mask = (1 << total_bits) - 1
+    # power-of-two widths keep the cascade from shifting bits across block boundaries
+    bits_per_dim = 8
+    while bits_per_dim * dims < total_bits:
+        bits_per_dim <<= 1
+    block_bytes, axis_bytes = bits_per_dim * dims // 8, bits_per_dim // 8
+    n_bytes = block_bytes * len(code_points)
+
+    packed = int.from_bytes(b"".join((c & code_mask).to_bytes(block_bytes, "little") for c in code_points), "little")
+
+    shifts, masks = _spread_steps(dims, bits_per_dim)
+    masks = [int.from_bytes(mask.to_bytes(block_bytes, "little") * len(code_points), "little") for mask in masks]
+
+    axes = []
+    for i in range(0, dims):
+        v = (packed >> i) & masks[-1]
+        for shift, mask in zip(reversed(shifts), reversed(masks[:-1])):
+            v = (v | (v >> shift)) & mask
+        v = v.to_bytes(n_bytes, "little")
+        axes.append([int.from_bytes(v[j:j + axis_bytes], "little") for j in range(0, n_bytes, block_bytes)])
+
+    return [list(data_point) for data_point in zip(*axes)]
+
+
+def par_deinterlace(code_points: List[int], dims: int = 3, total_bits: int = None) -> List[List[int]]:
+    """
+    Deinterlace a batch of 1D Morton code points into their multi-dimensional data points in parallel.
+
+    :param code_points: List[int]
+        The 1D Morton code points to decode.
+    :param dims: int
+        The dimensionality of the underlying data space.
+    :param total_bits: int, optional
+        The total bitsize of the Morton encoding.
+    :return: List[List[int]]
+        The multi-dimensional data points in the order of code_points.
+    """
+    if len(code_points) < _PAR_MIN_BATCH:
+        return _deinterlace_batch(code_points, dims, total_bits)
+
+    chunks = _chunks(code_points, 4 * mp.cpu_count())
+    data_points = _get_pool().starmap(_deinterlace_batch, [(chunk, dims, total_bits) for chunk in chunks])
+
+    return [data_point for chunk in data_points for data_point in chunk]
 
 
 def prev_morton(code_point: int, rmin_code: int, rmax_code: int, dims: int = 3, total_bits: int = None) -> int:
@@ -77,51 +365,52 @@ def prev_morton(code_point: int, rmin_code: int, rmax_code: int, dims: int = 3,
     :return: int
         The 1D Morton code point previous to code_point within range [rmin_code, rmax_code].
     """
+    if rmin_code == rmax_code:
+        # single point range; no need to scan
+        return rmax_code if rmax_code < code_point else 0
+
     if total_bits is None:
-        total_bits = max(1, code_point, rmin_code, rmax_code).bit_length()
+        total_bits = _max_bit_length((code_point, rmin_code, rmax_code))
         total_bits = total_bits + (dims - total_bits % dims)
 
-    CODE, MIN, MAX, LITMAX = (xmpz(code_point), xmpz(rmin_code), xmpz(rmax_code), xmpz())
+    axis_masks = _axis_masks(dims, total_bits)
+    code_mask = (1 << total_bits) - 1
+
+    CODE, MIN, MAX, LITMAX = (code_point, rmin_code, rmax_code, 0)
+    actions = _LITMAX_ACTIONS
 
     # bitwise scanning the codes of code_point and range_min_code and range_max_code starting from MSB
-    for i in reversed(range(0, total_bits)):
+    i = total_bits
+    while i > 0:
+        i -= 1
 
         # the three bits are examined according to LITMAX decision table
-        CODE_BIT, MIN_BIT, MAX_BIT = (CODE[i], MIN[i], MAX[i])
+        action = actions[((CODE >> i & 1) << 2) | ((MIN >> i & 1) << 1) | (MAX >> i & 1)]
 
-        if not CODE_BIT and not MIN_BIT and not MAX_BIT:
+        if not action:
             # No action; continue
             continue
-        elif not CODE_BIT and not MIN_BIT and MAX_BIT:
+        if action == _LOAD_MAX:
             # MAX = LOAD("0111...", MAX)
-            MAX[i % dims:i:dims] = 2 ** (i + 1) - 1
-            MAX[i] = 0
-            continue
-        elif not CODE_BIT and MIN_BIT and MAX_BIT:
-            # finish
-            return int(LITMAX)
-        elif CODE_BIT and not MIN_BIT and not MAX_BIT:
-            # LITMAX = MAX; finish
-            return int(MAX)
-        elif CODE_BIT and not MIN_BIT and MAX_BIT:
+            MAX = (MAX | (axis_masks[i % dims] & ((1 << i) - 1))) & ~(1 << i)
+        elif action == _SPLIT:
             # LITMAX = LOAD("0111...", MAX)
-            LITMAX[0:total_bits] = MAX[0:total_bits]
-            LITMAX[i % dims:i:dims] = 2**(i+1) - 1
-            LITMAX[i] = 0
+            LITMAX = ((MAX & code_mask) | (axis_masks[i % dims] & ((1 << i) - 1))) & ~(1 << i)
             # MIN = LOAD("10000...", MIN)
-            MIN[i % dims:i:dims] = 0
-            MIN[i] = 1
-            continue
-        elif CODE_BIT and MIN_BIT and MAX_BIT:
-            # No action; continue
-            continue
+            MIN = (MIN & ~(axis_masks[i % dims] & ((1 << i) - 1))) | (1 << i)
+        elif action == _RETURN_RESULT:
+            # finish
+            return LITMAX
+        elif action == _RETURN_MAX:
+            # LITMAX = MAX; finish
+            return MAX
         else:
             raise ValueError("This case not possible because MIN <= MAX")
 
-    return int(LITMAX)
+    return LITMAX
 
 
-def next_morton(code_point: int, rmin_code: int, rmax_code: int, dims: int = 3) -> int:
+def next_morton(code_point: int, rmin_code: int, rmax_code: int, dims: int = 3, total_bits: int = None) -> int:
     """
     Return 1D Morton code point next to given 1D Morton code_point within range [rmin_code, rmax_code].
 
@@ -133,61 +422,86 @@ def next_morton(code_point: int, rmin_code: int, rmax_code: int, dims: int = 3)
         The maximum range 1D Morton code point
     :param dims:
         The dimensionality of the underlying data space.
+    :param total_bits: int, optional
+        The total bitsize of the Morton encoding.
     :return: int
         The 1D Morton code point next to code_point within range [rmin_code, rmax_code].
     """
-    total_bits = max(1, code_point, rmin_code, rmax_code).bit_length()
-    total_bits = total_bits + (dims - total_bits % dims)
+    if rmin_code == rmax_code:
+        # single point range; no need to scan
+        return rmin_code if code_point < rmin_code else 0
 
-    CODE, MIN, MAX, BIGMIN = (xmpz(code_point), xmpz(rmin_code), xmpz(rmax_code), xmpz())
+    if total_bits is None:
+        total_bits = _max_bit_length((code_point, rmin_code, rmax_code))
+        total_bits = total_bits + (dims - total_bits % dims)
+
+    axis_masks = _axis_masks(dims, total_bits)
+    code_mask = (1 << total_bits) - 1
+
+    CODE, MIN, MAX, BIGMIN = (code_point, rmin_code, rmax_code, 0)
+    actions = _BIGMIN_ACTIONS
 
     # bitwise scanning the codes of code_point and range_min_code and range_max_code starting from MSB
-    for i in reversed(range(0, total_bits)):
+    i = total_bits
+    while i > 0:
+        i -= 1
 
         # the three bits are examined according to BIGMIN decision table
-        CODE_BIT, MIN_BIT, MAX_BIT = (CODE[i], MIN[i], MAX[i])
+        action = actions[((CODE >> i & 1) << 2) | ((MIN >> i & 1) << 1) | (MAX >> i & 1)]
 
-        if not CODE_BIT and not MIN_BIT and not MAX_BIT:
+        if not action:
             # No action; continue
             continue
-        elif not CODE_BIT and not MIN_BIT and MAX_BIT:
+        if action == _LOAD_MIN:
+            # MIN = LOAD("10000...", MIN)
+            MIN = (MIN & ~(axis_masks[i % dims] & ((1 << i) - 1))) | (1 << i)
+        elif action == _SPLIT:
             # BIGMIN=LOAD("1000...". MIN)
-            BIGMIN[0:total_bits] = MIN[0:total_bits]
-            BIGMIN[i % dims:i:dims] = 0
-            BIGMIN[i] = 1
+            BIGMIN = (MIN & code_mask & ~(axis_masks[i % dims] & ((1 << i) - 1))) | (1 << i)
             # MAX = LOAD("0111...", MAX)
-            MAX[i % dims:i:dims] = 2**(i+1) - 1
-            MAX[i] = 0
-            continue
-        elif not CODE_BIT and MIN_BIT and MAX_BIT:
+            MAX = (MAX | (axis_masks[i % dims] & ((1 << i) - 1))) & ~(1 << i)
+        elif action == _RETURN_MIN:
             # BIGMIN = MIN; finish
-            return int(MIN)
-        elif CODE_BIT and not MIN_BIT and not MAX_BIT:
+            return MIN
+        elif action == _RETURN_RESULT:
             # finish
-            return int(BIGMIN)
-        elif CODE_BIT and not MIN_BIT and MAX_BIT:
-            # MIN = LOAD("10000...", MIN)
-            MIN[i % dims:i:dims] = 0
-            MIN[i] = 1
-            continue
-        elif CODE_BIT and MIN_BIT and MAX_BIT:
-            # No action; continue
-            continue
+            return BIGMIN
         else:
             raise ValueError("This case not possible because MIN <= MAX")
 
-    return int(BIGMIN)
+    return BIGMIN
 
 
-def in_range(code_point: int, rmin_code: int, rmax_code: int, dims: int = 3, total_bits:int = None) -> bool:
+def in_range(code_point: int, rmin_code: int, rmax_code: int, dims: int = 3, total_bits: int = None) -> bool:
+    """
+    Check whether given 1D Morton code_point lies within the range [rmin_code, rmax_code].
+
+    :param code_point: int
+        A 1D Morton code point
+    :param rmin_code: int
+        The minimum range 1D Morton code point
+    :param rmax_code: int
+        The maximum range 1D Morton code point
+    :param dims:
+        The dimensionality of the underlying data space.
+    :param total_bits: int, optional
+        The total bitsize of the Morton encoding.
+    :return: bool
+        True if code_point lies within the range [rmin_code, rmax_code], False otherwise.
+    """
     if code_point < rmin_code or rmax_code < code_point:
         return False
     elif code_point == rmin_code or code_point == rmax_code:
         return True
-    else:
-        return code_point == prev_morton(next_morton(code_point, rmin_code, rmax_code, dims, total_bits),
-                                         rmin_code,
-                                         rmax_code,
-                                         dims,
-                                         total_bits)
 
+    # the range is the box spanned by rmin and rmax, hence a per-dimension check answers valid ranges right away
+    decode_bits = rmax_code.bit_length() if total_bits is None else total_bits
+    point, rmin, rmax = (deinterlace(c, dims, decode_bits) for c in (code_point, rmin_code, rmax_code))
+    if all(lo <= hi for lo, hi in zip(rmin, rmax)):
+        return all(lo <= v <= hi for lo, v, hi in zip(rmin, point, rmax))
+
+    return code_point == prev_morton(next_morton(code_point, rmin_code, rmax_code, dims, total_bits),
+                                     rmin_code,
+                                     rmax_code,
+                                     dims,
+                                     total_bits)